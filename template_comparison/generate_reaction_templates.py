@@ -9,24 +9,112 @@ import argparse
 from numpy.random import shuffle # for random selection
 import rdkit.Chem as Chem          # molecule building
 from rdkit.Chem import AllChem
-from collections import defaultdict
+from collections import defaultdict, Counter
 from rdkit import RDLogger
 import datetime # for info files
-import json # for dumping
+try:
+	import ujson as json # for dumping; drop-in and much faster on big dicts
+except ImportError:
+	import json # for dumping
 import sys  # for commanad line
 import os   # for file paths
-import re 
+import re
 import itertools
-import cPickle as pickle 
+import threading
+import multiprocessing
+from queue import Queue
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+
+# Precompiled patterns for atom-map label handling, compiled once at
+# module load instead of on every call in the hot loop
+_LABEL_RE = re.compile(r'\:[0-9]+\]')
+_LABEL_CAPTURE_RE = re.compile(r'\:([0-9]+)\]')
+_FRAGMENT_LABEL_RE = re.compile(r'\:([[0-9]+)\]')
+_CHARGE_RE = re.compile(r'([-+]+[1-9]?)')
+
+# Special-group templates, based on Functional_Group_Hierarchy.txt from
+# Greg Laandrum; parsed into pattern molecules once at import so
+# get_special_groups does not re-parse each SMARTS for every molecule
+_GROUP_TEMPLATES = [
+	'C(=O)Cl', # acid chloride
+	'C(=O)[O;H,-]', # carboxylic acid
+	'[$(S-!@[#6])](=O)(=O)(Cl)', # sulfonyl chloride
+	'[$(B-!@[#6])](O)(O)', # boronic acid
+	'[$(N-!@[#6])](=!@C=!@O)', # isocyanate
+	'[N;H0;$(N-[#6]);D2]=[N;D2]=[N;D1]', # azide
+	'O=C1N(Br)C(=O)CC1', # NBS brominating agent
+	'C=O', # carbonyl
+	'ClS(Cl)=O', # thionyl chloride
+	'[Mg][Br,Cl]', # grinard (non-disassociated)
+	'[#6]S(=O)(=O)[O]', # RSO3 leaving group
+	'[O]S(=O)(=O)[O]', # SO4 group
+	'[N-]=[N+]=[C]', # diazo-alkyl
+	]
+_GROUP_PATTERNS = [Chem.MolFromSmarts(template) for template in _GROUP_TEMPLATES]
+
+# Shared pool for SMILES parsing; RDKit releases the GIL inside
+# MolFromSmiles so parsing the components of a reaction scales with cores
+_smiles_pool = ThreadPoolExecutor(max_workers = os.cpu_count())
+
+def _log_noop(message, *args):
+	'''Default verbose logger: does nothing. Rebound to _log_verbose when
+	-v is set, so non-verbose runs skip the string formatting entirely'''
+	pass
+
+def _log_verbose(message, *args):
+	print(message.format(*args) if args else message)
+
+_log = _log_noop
+
+# Verbose flag and template-generality knobs get module-level defaults
+# so pool workers see them under any multiprocessing start method; under
+# spawn/forkserver the __main__ block never runs in the children
+v = False
+SUPER_GENERAL_TEMPLATES = True
+DO_NOT_TEST = True
+
+# Checkpoint snapshots are handed off to a background writer thread so
+# the hot loop never blocks on serializing the growing template dict.
+# Failures in the writer are stashed here and re-raised by the main
+# thread; raising inside the daemon would just kill it silently and
+# leave _flush_queue.join() blocked forever
+_flush_queue = Queue()
+_checkpoint_errors = []
+
+def _checkpoint_writer():
+	'''Daemon worker: takes (template_dict snapshot, file position) pairs
+	off the flush queue, dumps them to temporary files, and atomically
+	renames them into place so a crash never leaves a truncated file'''
+	while True:
+		snapshot, filepos = _flush_queue.get()
+		try:
+			with open(outfile + '.tmp', 'w') as fid:
+				json.dump(snapshot, fid)
+			os.replace(outfile + '.tmp', outfile)
+			with open(fileposfile + '.tmp', 'w') as fid:
+				json.dump(filepos, fid)
+			os.replace(fileposfile + '.tmp', fileposfile)
+		except Exception as e:
+			_checkpoint_errors.append(e)
+		finally:
+			_flush_queue.task_done()
 
 def mols_from_smiles_list(all_smiles):
 	'''Given a list of smiles strings, this function creates rdkit
-	molecules'''
-	mols = []
-	for smiles in all_smiles:
-		if not smiles: continue
-		mols.append(Chem.MolFromSmiles(smiles))
-	return mols
+	molecules, parsing them concurrently on the shared thread pool'''
+	all_smiles = [smiles for smiles in all_smiles if smiles]
+	return list(_smiles_pool.map(Chem.MolFromSmiles, all_smiles))
+
+def atom_smarts(atom):
+	'''Returns the SMARTS symbol for an RDKit atom, cached as a private
+	atom property so repeated lookups skip re-serialization in the C++
+	layer'''
+	if atom.HasProp('_cached_smarts'):
+		return atom.GetProp('_cached_smarts')
+	smarts = atom.GetSmarts()
+	atom.SetProp('_cached_smarts', smarts)
+	return smarts
 
 def bond_to_label(bond):
 	'''This function takes an RDKit bond and creates a label describing
@@ -43,6 +131,11 @@ def bond_to_label(bond):
 
 	return '{}{}{}'.format(atoms[0], bond.GetSmarts(), atoms[1])
 
+def atom_bond_labels(atom):
+	'''Returns the sorted tuple of bond labels around an RDKit atom, used
+	for comparing bonding environments between reactants and products'''
+	return tuple(sorted(bond_to_label(bond) for bond in atom.GetBonds()))
+
 def get_tagged_atoms_from_mols(mols):
 	'''Takes a list of RDKit molecules and returns total list of
 	atoms and their tags'''
@@ -60,15 +153,18 @@ def get_tagged_atoms_from_mol(mol):
 	atoms = []
 	atom_tags = []
 	for atom in mol.GetAtoms():
-		if ':' in atom.GetSmarts():
+		smarts = atom_smarts(atom)
+		if ':' in smarts:
 			atoms.append(atom)
-			atom_tags.append(atom.GetSmarts().split(':')[1][:-1])
+			atom_tags.append(int(smarts.split(':')[1][:-1]))
 	return atoms, atom_tags
 
-def atoms_are_different(atom1, atom2, level = 1):
-	'''Compares two RDKit atoms based on basic properties'''
+def atoms_are_different(atom1, atom2, bonds1 = None, bonds2 = None, level = 1):
+	'''Compares two RDKit atoms based on basic properties. Precomputed
+	bond-label tuples from atom_bond_labels can be passed in to avoid
+	rebuilding them for every candidate pair'''
 
-	if atom1.GetSmarts() != atom2.GetSmarts(): return True # should be very general
+	if atom_smarts(atom1) != atom_smarts(atom2): return True # should be very general
 	if atom1.GetAtomicNum() != atom2.GetAtomicNum(): return True # must be true for atom mapping
 	if atom1.GetTotalNumHs() != atom2.GetTotalNumHs(): return True
 	if atom1.GetFormalCharge() != atom2.GetFormalCharge(): return True
@@ -79,8 +175,8 @@ def atoms_are_different(atom1, atom2, level = 1):
 
 	# Check bonds and nearest neighbor identity
 	if level >= 1:
-		bonds1 = sorted([bond_to_label(bond) for bond in atom1.GetBonds()]) 
-		bonds2 = sorted([bond_to_label(bond) for bond in atom2.GetBonds()]) 
+		if bonds1 is None: bonds1 = atom_bond_labels(atom1)
+		if bonds2 is None: bonds2 = atom_bond_labels(atom2)
 		if bonds1 != bonds2: return True
 
 		# # Check neighbors too (already taken care of with previous lines)
@@ -96,35 +192,50 @@ def get_changed_atoms(reactants, products):
 	err = 0
 	prod_atoms, prod_atom_tags = get_tagged_atoms_from_mols(products)
 
-	if v: print('Products contain {} tagged atoms'.format(len(prod_atoms)))
-	if v: print('Products contain {} unique atom numbers'.format(len(set(prod_atom_tags))))
+	_log('Products contain {} tagged atoms', len(prod_atoms))
+	_log('Products contain {} unique atom numbers', len(set(prod_atom_tags)))
 
 	reac_atoms, reac_atom_tags = get_tagged_atoms_from_mols(reactants)
 	if len(set(prod_atom_tags)) != len(set(reac_atom_tags)):
-		if v: print('warning: different atom tags appear in reactants and products')
+		_log('warning: different atom tags appear in reactants and products')
 	if len(prod_atoms) != len(reac_atoms):
-		if v: print('warning: total number of tagged atoms differ, stoichometry != 1?')
+		_log('warning: total number of tagged atoms differ, stoichometry != 1?')
 		#err = 1
 
-	# Find differences 
+	# Find differences
 	changed_atoms = []
 	changed_atom_tags = []
+	changed_tag_set = set() # mirrors changed_atom_tags for O(1) membership
+
+	# Index reactant atoms by tag so each product tag is matched directly
+	# instead of rescanning the full reactant list (O(P*R) -> O(P+R))
+	reac_by_tag = defaultdict(list)
+	for j, reac_tag in enumerate(reac_atom_tags):
+		reac_by_tag[reac_tag].append(j)
+	prod_tag_counts = Counter(prod_atom_tags)
+
+	# Precompute bond environments so repeated comparisons of the same
+	# atom (multiple tag matches) do not re-enumerate and re-sort bonds
+	prod_bond_labels = [atom_bond_labels(atom) for atom in prod_atoms]
+	reac_bond_labels = [atom_bond_labels(atom) for atom in reac_atoms]
 
 	# Product atoms that are different from reactant atom equivalent
 	for i, prod_tag in enumerate(prod_atom_tags):
 
-		for j, reac_tag in enumerate(reac_atom_tags):
-			if reac_tag != prod_tag: continue
-			if reac_tag not in changed_atom_tags: # don't bother comparing if we know this atom changes
+		for j in reac_by_tag.get(prod_tag, ()):
+			if prod_tag not in changed_tag_set: # don't bother comparing if we know this atom changes
 				# If atom changed, add
-				if atoms_are_different(prod_atoms[i], reac_atoms[j]):
+				if atoms_are_different(prod_atoms[i], reac_atoms[j],
+						prod_bond_labels[i], reac_bond_labels[j]):
 					changed_atoms.append(reac_atoms[j])
-					changed_atom_tags.append(reac_tag)
+					changed_atom_tags.append(prod_tag)
+					changed_tag_set.add(prod_tag)
 					break
-				# If reac_tag appears multiple times, add (need for stoichometry > 1)
-				if prod_atom_tags.count(reac_tag) > 1:
+				# If prod_tag appears multiple times, add (need for stoichometry > 1)
+				if prod_tag_counts[prod_tag] > 1:
 					changed_atoms.append(reac_atoms[j])
-					changed_atom_tags.append(reac_tag)
+					changed_atom_tags.append(prod_tag)
+					changed_tag_set.add(prod_tag)
 					break
 
 	# Reactant atoms that do not appear in product (tagged leaving groups)
@@ -135,50 +246,51 @@ def get_changed_atoms(reactants, products):
 	# 			changed_atoms.append(reac_atoms[j])
 	# 			changed_atom_tags.append(reac_tag)
 
+	prod_tag_set = set(prod_atom_tags)
 	for mol in reactants:
 		use_this_mol = False
 		new_atoms, new_atom_tags = get_tagged_atoms_from_mol(mol)
 		for j, reac_tag in enumerate(new_atom_tags):
-			if reac_tag in changed_atom_tags:
-				use_this_mol = True 
+			if reac_tag in changed_tag_set:
+				use_this_mol = True
 		if use_this_mol:
 			for j, reac_tag in enumerate(new_atom_tags):
-				if reac_tag not in changed_atom_tags:
-					if reac_tag not in prod_atom_tags:
+				if reac_tag not in changed_tag_set:
+					if reac_tag not in prod_tag_set:
 						changed_atoms.append(reac_atoms[j])
 						changed_atom_tags.append(reac_tag)
+						changed_tag_set.add(reac_tag)
 
 	if v: 
 		print('{} tagged atoms in reactants change 1-atom properties'.format(len(changed_atom_tags)))
-		for smarts in [atom.GetSmarts() for atom in changed_atoms]:
+		for smarts in [atom_smarts(atom) for atom in changed_atoms]:
 			print('  {}'.format(smarts))
 
 	return changed_atoms, changed_atom_tags, err
 
 def expand_atoms_to_use(mol, atoms_to_use, groups = [], symbol_replacements = []):
-	'''Given an RDKit molecule and a list of AtomIdX which should be included
-	in the reaction, this function expands the list of AtomIdXs to include one 
+	'''Given an RDKit molecule and a set of AtomIdX which should be included
+	in the reaction, this function expands the set of AtomIdXs to include one
 	nearest neighbor with special consideration of (a) unimportant neighbors and
 	(b) important functional groupings'''
 
 	# Copy
-	new_atoms_to_use = atoms_to_use[:]
+	new_atoms_to_use = set(atoms_to_use)
 
-	# Look for all atoms in the current list of atoms to use
-	for atom in mol.GetAtoms():
-		if atom.GetIdx() not in atoms_to_use: continue
+	# Look for all atoms in the current set of atoms to use
+	for atom_idx in atoms_to_use:
 		# Look for all nearest neighbors of the currently-included atoms
-		for neighbor in atom.GetNeighbors():
+		for neighbor in mol.GetAtomWithIdx(atom_idx).GetNeighbors():
 			# Evaluate nearest neighbor atom to determine what should be included
 			new_atoms_to_use, symbol_replacements = \
-					expand_atoms_to_use_atom(mol, new_atoms_to_use, neighbor.GetIdx(), 
+					expand_atoms_to_use_atom(mol, new_atoms_to_use, neighbor.GetIdx(),
 						groups = groups, symbol_replacements = symbol_replacements)
-			
+
 	return new_atoms_to_use, symbol_replacements
 
 def expand_atoms_to_use_atom(mol, atoms_to_use, atom_idx, groups = [], symbol_replacements = []):
-	'''Given an RDKit molecule and a list of AtomIdx which should be included
-	in the reaction, this function extends the list of atoms_to_use by considering 
+	'''Given an RDKit molecule and a set of AtomIdx which should be included
+	in the reaction, this function extends the set of atoms_to_use by considering
 	a candidate atom extension, atom_idx'''
 
 	# Skip current candidate atom if it is already included
@@ -189,9 +301,9 @@ def expand_atoms_to_use_atom(mol, atoms_to_use, atom_idx, groups = [], symbol_re
 	found_in_group = False
 	for group in groups:
 		if int(atom_idx) in group: # int correction
-			if v: print('added group centered at {}'.format(atom_idx))
-			# Add the whole list, redundancies don't matter
-			atoms_to_use.extend(list(group)) 
+			_log('added group centered at {}', atom_idx)
+			# Add the whole group; the set handles redundancies
+			atoms_to_use.update(group)
 			found_in_group = True
 	if found_in_group:	return atoms_to_use, symbol_replacements
 		
@@ -199,7 +311,7 @@ def expand_atoms_to_use_atom(mol, atoms_to_use, atom_idx, groups = [], symbol_re
 	# Develop special SMARTS symbol
 
 	# Include this atom
-	atoms_to_use.append(atom_idx)
+	atoms_to_use.add(atom_idx)
 
 	# Look for replacements
 	symbol_replacements.append((atom_idx, convert_atom_to_wildcard(mol.GetAtomWithIdx(atom_idx))))
@@ -212,17 +324,19 @@ def convert_atom_to_wildcard(atom):
 	when candidate atoms are used to extend the reaction core for higher
 	generalizability'''
 
+	smarts = atom_smarts(atom)
+
 	if SUPER_GENERAL_TEMPLATES:
-		if ':' in atom.GetSmarts():
+		if ':' in smarts:
 			# Fully generalize atom-mappped neighbors because they are aren't a leaving group
-			label = re.search('\:[0-9]+\]', atom.GetSmarts())
+			label = _LABEL_RE.search(smarts)
 			return '[*{}'.format(label.group())
 
 	if not SUPER_GENERAL_TEMPLATES:
 
 		# Is this a terminal atom? We can tell if the degree is one
 		if atom.GetDegree() == 1:
-			return atom.GetSmarts()
+			return smarts
 
 	# Initialize
 	symbol = '['
@@ -238,22 +352,21 @@ def convert_atom_to_wildcard(atom):
 	if not SUPER_GENERAL_TEMPLATES:
 		# Charge is important
 		if atom.GetFormalCharge() != 0:
-			charges = re.search('([-+]+[1-9]?)', atom.GetSmarts())
+			charges = _CHARGE_RE.search(smarts)
 			if charges: symbol += charges.group() + ';'
 
 	# Strip extra semicolon
 	if symbol[-1] == ';': symbol = symbol[:-1]
 
 	# Close with label or with bracket
-	label = re.search('\:[0-9]+\]', atom.GetSmarts())
-	if label: 
+	label = _LABEL_RE.search(smarts)
+	if label:
 		symbol += label.group()
 	else:
 		symbol += ']'
 
-	if v: 
-		if symbol != atom.GetSmarts():
-			print('Improved generality of atom SMARTS {} -> {}'.format(atom.GetSmarts(), symbol))
+	if symbol != smarts:
+		_log('Improved generality of atom SMARTS {} -> {}', smarts, symbol)
 
 	return symbol
 
@@ -263,7 +376,8 @@ def get_fragments_for_changed_atoms(mols, changed_atom_tags, radius = 0,
 	computes the SMILES string of molecular fragments using MolFragmentToSmiles 
 	for all changed fragments'''
 
-	fragments = ''
+	fragment_parts = []
+	changed_atom_tags = set(changed_atom_tags) # O(1) membership below
 	for mol in mols:
 		# Initialize list of replacement symbols (updated during expansion)
 		symbol_replacements = []
@@ -274,14 +388,25 @@ def get_fragments_for_changed_atoms(mols, changed_atom_tags, radius = 0,
 		else:
 			groups = []
 
-		# Build list of atoms to use
-		atoms_to_use = []
-		for atom in mol.GetAtoms():
+		# Build set of atoms to use (O(1) membership during expansion), the
+		# symbols array, the tag->index map, and the unmapped-atom list in
+		# a single pass over the atoms
+		atoms_list = list(mol.GetAtoms())
+		symbols = [None] * len(atoms_list)
+		atoms_to_use = set()
+		tag_to_idx = {}
+		unmapped_idxs = []
+		for atom in atoms_list:
+			idx = atom.GetIdx()
+			smarts = atom_smarts(atom)
+			symbols[idx] = smarts
 			# Check self (only tagged atoms)
-			if ':' in atom.GetSmarts():
-				if atom.GetSmarts().split(':')[1][:-1] in changed_atom_tags:
-					atoms_to_use.append(atom.GetIdx())
-					symbol = atom.GetSmarts()
+			if ':' in smarts:
+				tag = int(smarts.split(':')[1][:-1])
+				tag_to_idx[tag] = idx
+				if tag in changed_atom_tags:
+					atoms_to_use.add(idx)
+					symbol = smarts
 					# CUSTOM SYMBOL CHANGES
 					if atom.GetTotalNumHs() == 0:
 						# Be explicit when there are no hydrogens
@@ -289,43 +414,42 @@ def get_fragments_for_changed_atoms(mols, changed_atom_tags, radius = 0,
 							symbol = symbol.replace(':', ';H0:')
 						else: # stick before end
 							symbol = symbol.replace(']', ';H0]')
-						
+
 						# print('Being explicit about H0!!!!')
 					if atom.GetFormalCharge() == 0:
 						# Also be explicit when there is no charge
-						if ':' in symbol: 
+						if ':' in symbol:
 							symbol = symbol.replace(':', ';+0:')
 						else:
 							symbol = symbol.replace(']', ';+0]')
-					if symbol != atom.GetSmarts():
-						symbol_replacements.append((atom.GetIdx(), symbol))
-					continue
+					if symbol != smarts:
+						symbol_replacements.append((idx, symbol))
+			else:
+				# no SMARTS label -> no molAtomMapNumber on this atom
+				unmapped_idxs.append(idx)
 
 		# Check neighbors (any atom)
 		for k in range(radius):
-			atoms_to_use, symbol_replacements = expand_atoms_to_use(mol, atoms_to_use, 
+			atoms_to_use, symbol_replacements = expand_atoms_to_use(mol, atoms_to_use,
 				groups = groups, symbol_replacements = symbol_replacements)
 
 		if category == 'products':
-			# Add extra labels to include (for products only)
-			if expansion:
-				for atom in mol.GetAtoms():
-					if ':' not in atom.GetSmarts(): continue
-					label = atom.GetSmarts().split(':')[1][:-1]
-					if label in expansion and label not in changed_atom_tags:
-						atoms_to_use.append(atom.GetIdx())
-						# Make the expansion a wildcard
-						symbol_replacements.append((atom.GetIdx(), convert_atom_to_wildcard(atom)))	
-						if v: print('expanded label {} to wildcard in products'.format(label))
-			
+			# Add extra labels to include (for products only); look each
+			# expansion tag up directly instead of rescanning the atoms
+			for label in expansion:
+				if label in changed_atom_tags: continue
+				idx = tag_to_idx.get(label)
+				if idx is None: continue
+				atoms_to_use.add(idx)
+				# Make the expansion a wildcard
+				symbol_replacements.append((idx, convert_atom_to_wildcard(atoms_list[idx])))
+				_log('expanded label {} to wildcard in products', label)
+
 			# Make sure unmapped atoms are included (from products)
-			for atom in mol.GetAtoms():
-				if not atom.HasProp('molAtomMapNumber'): 
-					atoms_to_use.append(atom.GetIdx())
+			atoms_to_use.update(unmapped_idxs)
 
-		# Define new symbols to replace terminal species with wildcards
+		# Apply new symbols to replace terminal species with wildcards
 		# (don't want to restrict templates too strictly)
-		symbols = [atom.GetSmarts() for atom in mol.GetAtoms()]
 		for (i, symbol) in symbol_replacements:
 			symbols[i] = symbol
 
@@ -334,25 +458,30 @@ def get_fragments_for_changed_atoms(mols, changed_atom_tags, radius = 0,
 		# 	print('~~ replacement for this ' + category[:-1])
 		# 	print('{} -> {}'.format([mol.GetAtomWithIdx(x).GetSmarts() for (x, s) in symbol_replacements], 
 		# 		                    [s for (x, s) in symbol_replacements]))
-		# Remove molAtomMapNumber before canonicalization
-		[x.ClearProp('molAtomMapNumber') for x in mol.GetAtoms()]
-		fragments += '(' + AllChem.MolFragmentToSmiles(mol, atoms_to_use, 
-			atomSymbols = symbols, allHsExplicit = True, 
-			isomericSmiles = False, allBondsExplicit = True) + ').'
-	return fragments[:-1]
+		# Remove molAtomMapNumber before canonicalization; plain loop over
+		# the cached atom list, no throwaway result list
+		for atom in atoms_list:
+			atom.ClearProp('molAtomMapNumber')
+		fragment_parts.append(AllChem.MolFragmentToSmiles(mol, sorted(atoms_to_use),
+			atomSymbols = symbols, allHsExplicit = True,
+			isomericSmiles = False, allBondsExplicit = True))
+	if not fragment_parts: return ''
+	return '(' + ').('.join(fragment_parts) + ')'
 
 def expand_changed_atom_tags(changed_atom_tags, reactant_fragments):
-	'''Given a list of changed atom tags (numbers as strings) and a string consisting
-	of the reactant_fragments to include in the reaction transform, this function 
-	adds any tagged atoms found in the reactant side of the template to the 
+	'''Given a list of changed atom tags (numbers as ints) and a string consisting
+	of the reactant_fragments to include in the reaction transform, this function
+	adds any tagged atoms found in the reactant side of the template to the
 	changed_atom_tags list so that those tagged atoms are included in the products'''
 
 	expansion = []
-	atom_tags_in_reactant_fragments = re.findall('\:([[0-9]+)\]', reactant_fragments)
+	changed_atom_tags = set(changed_atom_tags)
+	atom_tags_in_reactant_fragments = _FRAGMENT_LABEL_RE.findall(reactant_fragments)
 	for atom_tag in atom_tags_in_reactant_fragments:
+		atom_tag = int(atom_tag)
 		if atom_tag not in changed_atom_tags:
 			expansion.append(atom_tag)
-	if v: print('after building reactant fragments, additional labels included: {}'.format(expansion))
+	_log('after building reactant fragments, additional labels included: {}', expansion)
 	return expansion
 
 def get_special_groups(mol):
@@ -363,27 +492,10 @@ def get_special_groups(mol):
 
 	if SUPER_GENERAL_TEMPLATES: return []
 
-	# Define templates, based on Functional_Group_Hierarchy.txt from Greg Laandrum
-	group_templates = [ 
-		'C(=O)Cl', # acid chloride
-		'C(=O)[O;H,-]', # carboxylic acid
-		'[$(S-!@[#6])](=O)(=O)(Cl)', # sulfonyl chloride
-		'[$(B-!@[#6])](O)(O)', # boronic acid
-		'[$(N-!@[#6])](=!@C=!@O)', # isocyanate
-		'[N;H0;$(N-[#6]);D2]=[N;D2]=[N;D1]', # azide
-		'O=C1N(Br)C(=O)CC1', # NBS brominating agent
-		'C=O', # carbonyl
-		'ClS(Cl)=O', # thionyl chloride
-		'[Mg][Br,Cl]', # grinard (non-disassociated)
-		'[#6]S(=O)(=O)[O]', # RSO3 leaving group
-		'[O]S(=O)(=O)[O]', # SO4 group
-		'[N-]=[N+]=[C]', # diazo-alkyl
-		]
-
 	# Build list
 	groups = []
-	for template in group_templates:
-		matches = mol.GetSubstructMatches(Chem.MolFromSmarts(template))
+	for pattern in _GROUP_PATTERNS:
+		matches = mol.GetSubstructMatches(pattern)
 		groups.extend(list(matches))
 	return groups
 
@@ -396,13 +508,14 @@ def mol_list_from_inchi(inchis):
 	'''InChI string separated by ++ to list of RDKit molecules'''
 	return [Chem.MolFromInchi(inchi.strip()) for inchi in inchis.split('++')]
 
+@lru_cache(maxsize = 200000)
 def canonicalize_template(template):
 	'''This function takes one-half of a template SMARTS string 
 	(i.e., reactants or products) and re-orders them based on
 	an equivalent string without atom mapping.'''
 
 	# Strip labels to get sort orders
-	template_nolabels = re.sub('\:[0-9]+\]', ']', template)
+	template_nolabels = _LABEL_RE.sub(']', template)
 
 	# Split into separate molecules *WITHOUT wrapper parentheses*
 	template_nolabels_mols = template_nolabels[1:-1].split(').(')
@@ -414,14 +527,15 @@ def canonicalize_template(template):
 		mol_frags         = template_mols[i].split('.')
 
 		# Get sort order within molecule, defined WITHOUT labels
-		sortorder = [j[0] for j in sorted(enumerate(nolabel_mol_frags), key = lambda x:x[1])]
+		# (sorting indices directly avoids per-element tuple + lambda cost)
+		sortorder = sorted(range(len(nolabel_mol_frags)), key = nolabel_mol_frags.__getitem__)
 
 		# Apply sorting and merge list back into overall mol fragment
 		template_nolabels_mols[i] = '.'.join([nolabel_mol_frags[j] for j in sortorder])
 		template_mols[i]          = '.'.join([mol_frags[j] for j in sortorder])
 
 	# Get sort order between molecules, defined WITHOUT labels
-	sortorder = [j[0] for j in sorted(enumerate(template_nolabels_mols), key = lambda x:x[1])]
+	sortorder = sorted(range(len(template_nolabels_mols)), key = template_nolabels_mols.__getitem__)
 
 	# Apply sorting and merge list back into overall transform
 	template = '(' + ').('.join([template_mols[i] for i in sortorder]) + ')'
@@ -433,25 +547,18 @@ def reassign_atom_mapping(transform):
 	the atom-mapping labels (numbers) from left to right, once 
 	that transform has been canonicalized.'''
 
-	all_labels = re.findall('\:([0-9]+)\]', transform)
-
-	# Define list of replacements which matches all_labels *IN ORDER*
-	replacements = []
+	# Relabel in a single left-to-right pass; each old label gets its new
+	# number the first time it is seen (keep in order! this is important)
 	replacement_dict = {}
-	counter = 1
-	for label in all_labels: # keep in order! this is important
+	def replace_label(match):
+		label = match.group(1)
 		if label not in replacement_dict:
-			replacement_dict[label] = str(counter)
-			counter += 1
-		replacements.append(replacement_dict[label])
-
-	# Perform replacements in order
-	transform_newmaps = re.sub('\:[0-9]+\]', 
-		lambda match: (':' + replacements.pop(0) + ']'),
-		transform)
+			replacement_dict[label] = str(len(replacement_dict) + 1)
+		return ':' + replacement_dict[label] + ']'
 
-	return transform_newmaps
+	return _LABEL_CAPTURE_RE.sub(replace_label, transform)
 
+@lru_cache(maxsize = 200000)
 def canonicalize_transform(transform):
 	'''This function takes an atom-mapped SMARTS transform and
 	converts it to a canonical form by, if nececssary, rearranging
@@ -461,6 +568,7 @@ def canonicalize_transform(transform):
 	transform_reordered = '>>'.join([canonicalize_template(x) for x in transform.split('>>')])
 	return reassign_atom_mapping(transform_reordered)
 
+@lru_cache(maxsize = 200000)
 def convert_to_retro(transform):
 	'''This function takes a forward synthesis and converts it to a
 	retrosynthesis. Only transforms with a single product are kept, since 
@@ -479,8 +587,129 @@ def convert_to_retro(transform):
 
 	return '>>'.join([products, reactants])
 
+@lru_cache(maxsize = 200000)
+def retro_canonical_from_rxn_string(rxn_string):
+	'''Shortcut from a raw fragment transform to its retro-canonical
+	form: repeated rxn_strings resolve with one bounded-cache lookup
+	instead of re-entering the canonicalization pipeline'''
+	return convert_to_retro(canonicalize_transform(rxn_string))
+
+def _init_worker():
+	'''Pool initializer: recreate per-process helpers that do not survive
+	a fork (the SMILES-parsing thread pool has dead threads in children)'''
+	global _smiles_pool
+	# a couple of threads per worker process is plenty once the line-level
+	# work is already spread across cores
+	_smiles_pool = ThreadPoolExecutor(max_workers = 2)
+
+def process_line(line):
+	'''Extracts the retro-canonical transform from a single reaction
+	record. Returns ('ok', transform) on success or (reason, None) when
+	the reaction should be skipped; runs inside pool worker processes'''
+
+	try:
+		# Unpack; parse the products first so partially-mapped reactions
+		# are rejected before paying for the (usually larger) reactant
+		# side. Agents are never used downstream, so skip them entirely
+		reaction_smiles = str(line.split()[0])
+		reactant_smiles, agent_smiles, product_smiles = reaction_smiles.split('>')
+		products = mols_from_smiles_list(product_smiles.split('.'))
+		[Chem.SanitizeMol(mol) for mol in products]
+
+	except Exception as e:
+		# can't sanitize -> skip
+		print('Could not load SMILES or sanitize')
+		print(line)
+		return ('unparseable', None)
+
+	# Check product atom mapping before touching the reactants; all()
+	# bails out on the first unmapped atom instead of scanning them all
+	for product in products:
+		if not all(a.HasProp('molAtomMapNumber') for a in product.GetAtoms()):
+			print('Not all product atoms have atom mapping, skipping')
+			print('REACTION: {}'.format(reaction_smiles))
+			return ('partialmapped', None)
+
+	try:
+		reactants = mols_from_smiles_list(reactant_smiles.split('.'))
+		[Chem.SanitizeMol(mol) for mol in reactants]
+
+	except Exception as e:
+		# can't sanitize -> skip
+		print('Could not load SMILES or sanitize')
+		print(line)
+		return ('unparseable', None)
+
+	try:
+		_log(reaction_smiles)
+		if None in reactants + products:
+			print('Could not parse all molecules in reaction, skipping')
+			print('smiles: {}'.format(reaction_smiles))
+			return ('unparseable', None)
+
+		# Calculate changed atoms
+		changed_atoms, changed_atom_tags, err = get_changed_atoms(reactants, products)
+		if err:
+			print('Could not get changed atoms')
+			print('smiles: {}'.format(reaction_smiles))
+			return ('skipped', None)
+		if not changed_atom_tags:
+			print('No atoms changed?')
+			print('smiles: {}'.format(reaction_smiles))
+			return ('skipped', None)
+
+		# Get fragments for reactants
+		reactant_fragments = get_fragments_for_changed_atoms(reactants, changed_atom_tags,
+			radius = 1, expansion = [], category = 'reactants')
+		# Get fragments for products
+		# (WITHOUT matching groups but WITH the addition of reactant fragments)
+		product_fragments  = get_fragments_for_changed_atoms(products, changed_atom_tags,
+			radius = 0, expansion = expand_changed_atom_tags(changed_atom_tags, reactant_fragments),
+			category = 'products')
+
+		# Report transform
+		rxn_string = '{}>>{}'.format(reactant_fragments, product_fragments)
+		_log('\nOverall fragment transform: {}', rxn_string)
+
+		# Load into RDKit
+		rxn = AllChem.ReactionFromSmarts(rxn_string)
+		if rxn.Validate()[1] != 0:
+			print('Could not validate reaction successfully')
+			print('smiles: {}'.format(reaction_smiles))
+			print('rxn_string: '.format(rxn_string))
+			return ('skipped', None)
+		# print('here')
+
+		# Valid reaction!
+		retro_canonical = retro_canonical_from_rxn_string(rxn_string)
+
+		return ('ok', retro_canonical)
+
+	except Exception as e:
+		print(e)
+		print('skipping')
+		return ('skipped', None)
+
+def _lines_with_offsets(fid, offset):
+	'''Yields (line, end_offset) pairs from a reaction file opened in
+	binary mode. file.tell() is disabled while iterating (and would race
+	ahead of the pool's feeder thread anyway), so the byte offset is
+	accumulated per raw line before decoding; seek() on the binary file
+	then consumes exactly these offsets on resume'''
+	for raw_line in fid:
+		offset += len(raw_line)
+		yield (raw_line.decode('utf-8'), offset)
+
+def _process_entry(entry):
+	'''Pool adapter: unpacks the (line, end_offset) pairs produced by
+	_lines_with_offsets and tags the process_line result with the offset
+	so the parent can checkpoint a position matching what it aggregated'''
+	line, end_offset = entry
+	status, result = process_line(line)
+	return (status, result, end_offset)
+
 def main(N = 15, folder = ''):
-	'''Read reactions'''
+	'''Read reactions, fanning the per-line work out across processes'''
 	global v
 
 	# Define scoring variables
@@ -491,112 +720,47 @@ def main(N = 15, folder = ''):
 	total_partialmapped = 0
 	total_nonreaction = 0
 
-	# Look for entries
-	i = -1
-	for line in reaction_fid:
-		i += 1
-
-		if v: 
-			print('##################################')
-			print('###        RXN {}'.format(i))
-			print('##################################')
-
-
-		try:
-			# Unpack
-			reaction_smiles = str(line.split()[0])
-			reactants, agents, products = [mols_from_smiles_list(x) for x in 
-										[mols.split('.') for mols in reaction_smiles.split('>')]]
-			[Chem.SanitizeMol(mol) for mol in reactants + agents + products]
+	# Each line is independent; only the template counting is shared, so
+	# it stays in the parent while workers do the RDKit-heavy parsing
+	pool = multiprocessing.Pool(os.cpu_count(), initializer = _init_worker)
 
-		except Exception as e:
-			# can't sanitize -> skip
-			raise(e)
-			print('Could not load SMILES or sanitize')
-			print(line)
-			continue
-		
-		try:
-			# Check product atom mapping
-			skip = False
-			for product in products:
-				if sum([a.HasProp('molAtomMapNumber') for a in product.GetAtoms()]) < len(product.GetAtoms()):
-					print('Not all product atoms have atom mapping, skipping')
-					print('REACTION: {}'.format(reaction_smiles))
-					skip = True
-			if skip: 
+	# Look for entries. Results come back in order, so once a result is
+	# consumed here every earlier line has been aggregated too, and its
+	# end offset is a safe position to resume from
+	i = -1
+	last_offset = filepos
+	try:
+		for status, retro_canonical, end_offset in pool.imap(_process_entry,
+				_lines_with_offsets(reaction_fid, filepos), chunksize = 64):
+			i += 1
+			last_offset = end_offset
+
+			if status == 'partialmapped':
 				total_partialmapped += 1
-				continue
-
-			if v: print(reaction_smiles)
-			if None in reactants + products:
-				print('Could not parse all molecules in reaction, skipping')
-				print('smiles: {}'.format(reaction_smiles))
-				continue
-
-			# Calculate changed atoms
-			changed_atoms, changed_atom_tags, err = get_changed_atoms(reactants, products)
-			if err: 
-				print('Could not get changed atoms')
-				print('smiles: {}'.format(reaction_smiles))
-				continue
-			if not changed_atom_tags:
-				print('No atoms changed?')
-				print('smiles: {}'.format(reaction_smiles))
-				continue
-
-			# Get fragments for reactants
-			reactant_fragments = get_fragments_for_changed_atoms(reactants, changed_atom_tags, 
-				radius = 1, expansion = [], category = 'reactants')
-			# Get fragments for products 
-			# (WITHOUT matching groups but WITH the addition of reactant fragments)
-			product_fragments  = get_fragments_for_changed_atoms(products, changed_atom_tags, 
-				radius = 0, expansion = expand_changed_atom_tags(changed_atom_tags, reactant_fragments),
-				category = 'products')
-
-			# Report transform
-			rxn_string = '{}>>{}'.format(reactant_fragments, product_fragments)
-			if v: print('\nOverall fragment transform: {}'.format(rxn_string))
-
-			# Load into RDKit
-			rxn = AllChem.ReactionFromSmarts(rxn_string)
-			if rxn.Validate()[1] != 0: 
-				print('Could not validate reaction successfully')
-				print('smiles: {}'.format(reaction_smiles))
-				print('rxn_string: '.format(rxn_string))
-				continue
-			# print('here')
-
-			# Valid reaction!
-			rxn_canonical = canonicalize_transform(rxn_string)
-			retro_canonical = convert_to_retro(rxn_canonical)
-
-			## Increment counter
-			template_dict[retro_canonical] += 1
-
-			total_attempted += 1
-		
-		except Exception as e:
-			raise(e)
-			print(e)
-			print('skipping')
-			#raw_input('Enter anything to continue')
-			continue
-
-
-		# Report progress
-		if (i % 100) == 0:
-			print('{} done'.format(i))
-
-		if (i % 10000) == 0: 
-			print('## logging ##')
-			with open(outfile, 'wb') as fid: 
-				json.dump(template_dict, fid)
-			with open(fileposfile, 'w') as fid: 
-				json.dump(reaction_fid.tell(), fid)
+			elif status == 'ok':
+				## Increment counter
+				template_dict[retro_canonical] += 1
+				total_attempted += 1
+
+			# Report progress
+			if (i % 100) == 0:
+				print('{} done'.format(i))
+
+			if (i % 10000) == 0:
+				print('## logging ##')
+				_flush_queue.put((dict(template_dict), last_offset))
+	except BaseException:
+		# don't let close() wait for the feeder to push the rest of the
+		# input through the pool before the error surfaces
+		pool.terminate()
+		raise
+	else:
+		pool.close()
+	finally:
+		pool.join()
 
-		if v: 
-			raw_input('pause')
+	# Checkpoint the tail that never reached the every-10000 mark
+	_flush_queue.put((dict(template_dict), last_offset))
 
 	total_examples = i + 1
 	print('...finished looking through {} reaction records'.format(min([N, i + 1])))
@@ -626,12 +790,10 @@ if __name__ == '__main__':
 	args = parser.parse_args()
 
 	v = args.v
+	if v: _log = _log_verbose
 	lg = RDLogger.logger()
 	if not v: lg.setLevel(4)
 
-	SUPER_GENERAL_TEMPLATES = True
-	DO_NOT_TEST = True
-
 	infile = args.infile
 	outfile = 'templates.json'
 	fileposfile = 'filepos.txt'
@@ -647,7 +809,18 @@ if __name__ == '__main__':
 
 	template_dict = defaultdict(int, template_dict)
 
-	reaction_fid = open(infile)
+	writer_thread = threading.Thread(target = _checkpoint_writer)
+	writer_thread.daemon = True
+	writer_thread.start()
+
+	# Binary mode: resume offsets are byte counts, and text-mode seek()
+	# only accepts opaque tell() cookies anyway
+	reaction_fid = open(infile, 'rb')
 	reaction_fid.seek(filepos)
-	main()
-	reaction_fid.close()
\ No newline at end of file
+	try:
+		main()
+	finally:
+		_flush_queue.join() # make sure the last enqueued checkpoint is on disk
+		reaction_fid.close()
+	if _checkpoint_errors:
+		raise _checkpoint_errors[0]
\ No newline at end of file